@@ -1,4 +1,3 @@
-import argparse
 import sys
 
 from demo.aliases import *
@@ -7,6 +6,22 @@ from demo.script import *
 __all__ = ['register', 'Script', 'get_argparser', 'main']
 
 
+_default_prompt = '[%(nextcmd)s]> '
+
+
+class _Options(object):
+    """
+    Simple container for the options parsed by _fast_parse().
+    """
+
+    def __init__(self, **kwargs):
+        """
+        Initialize the options from the keyword arguments.
+        """
+
+        self.__dict__.update(kwargs)
+
+
 def get_argparser(argparser=None):
     """
     Generates an argparse.ArgumentParser object with the required
@@ -16,6 +31,8 @@ def get_argparser(argparser=None):
     generating a new one.
     """
 
+    import argparse
+
     # Build the initial argument parser
     if argparser is None:
         argparser = argparse.ArgumentParser(description="Run demo scripts")
@@ -26,7 +43,7 @@ def get_argparser(argparser=None):
     argparser.add_argument('-o', '--output', dest='output', action='store',
                            help="Output commands to new demo file")
     argparser.add_argument('-p', '--prompt', dest='prompt', action='store',
-                           default='[%(nextcmd)s]> ',
+                           default=_default_prompt,
                            help="Prompt to use in interactive usage")
     argparser.add_argument('-d', '--debug', dest='debug', action='store_true',
                            default=False, help="Enable debugging output")
@@ -34,25 +51,84 @@ def get_argparser(argparser=None):
     return argparser
 
 
+def _fast_parse(args):
+    """
+    Parses the demo command line `args` without using argparse, which
+    is comparatively expensive to import and set up.  Only handles
+    the common, valid invocations; returns None if `args` contains
+    anything else (including requests for help), in which case the
+    caller must fall back to the argparse.ArgumentParser from
+    get_argparser().
+    """
+
+    opts = _Options(files=[], output=None, prompt=_default_prompt,
+                    debug=False)
+    valopts = {
+        '-o': 'output',
+        '--output': 'output',
+        '-p': 'prompt',
+        '--prompt': 'prompt',
+    }
+
+    # argparse collects all the file names at once, so it rejects
+    # file names that follow an option which follows file names
+    files_done = False
+
+    args = iter(args)
+    for arg in args:
+        if arg == '--':
+            # Everything else is a file name
+            if files_done:
+                return None
+            opts.files.extend(args)
+            break
+        elif arg in ('-d', '--debug'):
+            opts.debug = True
+        elif arg in valopts:
+            value = next(args, None)
+            if value is None or value.startswith('-'):
+                return None
+            setattr(opts, valopts[arg], value)
+        elif arg.startswith('--') and '=' in arg:
+            name, value = arg.split('=', 1)
+            if name not in valopts:
+                return None
+            setattr(opts, valopts[name], value)
+        elif arg == '-' or not arg.startswith('-'):
+            if files_done:
+                return None
+            opts.files.append(arg)
+            continue
+        else:
+            return None
+
+        # Any option ends the list of file names
+        files_done = bool(opts.files)
+
+    # At least one file is required
+    return opts if opts.files else None
+
+
 def main(argparser=None, args=None):
     """
     Main demo script processor.  If `argparser` is not specified, a
-    new one will be generated by calling get_argparser(); otherwise,
+    new one will be generated by calling get_argparser() if the
+    command line is too complex for _fast_parse(); otherwise,
     `argparser` must be from a call to get_argparser().  If `args` is
     specified, it must be a list of arguments passed to demo;
     otherwise, arguments are derived from sys.argv[1:].
     """
 
-    # Get an argument parser
-    if argparser is None:
-        argparser = get_argparser()
-
     # What arguments are we parsing?
     if args is None:
         args = sys.argv[1:]
 
-    # Get our options
-    opts = argparser.parse_args(args)
+    # Get our options, avoiding argparse if we can
+    opts = _fast_parse(args) if argparser is None else None
+    if opts is None:
+        if argparser is None:
+            argparser = get_argparser()
+        opts = argparser.parse_args(args)
 
     # Initialize the Script object...
     sc = Script(opts)
@@ -1,11 +1,21 @@
 import os
-import pwd
-import subprocess
 import sys
 
 __all__ = ['register']
 
 
+# Cache of the callables located by "from" statements, keyed by module
+# and callable name
+_import_cache = {}
+
+# Valid shapes of a "from" statement: maps the number of arguments to
+# the keywords expected and their positions
+_from_shapes = {
+    4: (('import', 2),),
+    6: (('import', 2), ('as', 4)),
+}
+
+
 class Alias(object):
     """
     Represents an alias, or a demo script command line.  Aliases are
@@ -13,7 +23,10 @@ class Alias(object):
     lookup and alias creation, depending on input arguments.
     """
 
+    __slots__ = ('alias', 'func')
+
     _aliases = {}
+    _resolved = {}
 
     def __new__(cls, alias, func=None):
         """
@@ -23,29 +36,48 @@ class Alias(object):
         by `func`.
         """
 
+        # If func is not given, we're doing a lookup
+        if func is None:
+            return cls.lookup(alias)
+
         # See if the alias already exists
-        if alias in cls._aliases:
+        obj = cls._aliases.get(alias)
+        if obj is not None:
             # Replace the function
-            obj = cls._aliases[alias]
-            if func is not None:
-                obj.func = func
+            obj.func = func
             return obj
 
-        # If func is not given, we were doing a lookup
-        if func is None:
-            # Return the default alias
-            return cls._aliases[None]
-
-        # OK, gotta allocate a new one
+        # OK, gotta allocate a new one; intern the name so lookups
+        # with interned command names can match by identity
+        if isinstance(alias, str):
+            alias = intern(alias)
         obj = super(Alias, cls).__new__(cls)
         obj.alias = alias
         obj.func = func
 
-        # Cache it
+        # Cache it; the new alias may shadow a previously resolved
+        # default
         cls._aliases[alias] = obj
+        cls._resolved.clear()
 
         return obj
 
+    @classmethod
+    def lookup(cls, alias):
+        """
+        Looks up an alias by name, returning the default alias if
+        there is no alias with the name `alias`.  Never creates an
+        alias.
+        """
+
+        obj = cls._resolved.get(alias)
+        if obj is None:
+            # Resolve the alias, falling back to the default, and
+            # remember the result
+            obj = cls._aliases.get(alias) or cls._aliases[None]
+            cls._resolved[alias] = obj
+        return obj
+
     def execute(self, ctx, sc_line):
         """
         Executes the alias, passing it the script context `ctx` and
@@ -96,9 +128,14 @@ def default(ctx, sc_line):
     shell).
     """
 
-    # Build the environment
-    env = os.environ.copy()
-    env.update(sc_line.vardict)
+    import subprocess
+
+    # Build the environment; without per-command variables, the child
+    # simply inherits ours
+    env = None
+    if sc_line.vardict:
+        env = os.environ.copy()
+        env.update(sc_line.vardict)
     subprocess.check_call(sc_line.args, env=env)
 
 
@@ -126,9 +163,9 @@ def do_from(ctx, sc_line):
     """
 
     # Sanity-check syntax
-    if (len(sc_line.args) not in (4, 6) or
-        sc_line.args[2] != 'import' or
-        (len(sc_line.args) == 6 and sc_line.args[4] != 'as')):
+    shape = _from_shapes.get(len(sc_line.args))
+    if shape is None or any(sc_line.args[idx] != keyword
+                            for keyword, idx in shape):
         raise SyntaxError('Invalid "from" statement; use as '
                           '"from <module> import <func> [as <alias>]"')
 
@@ -136,18 +173,25 @@ def do_from(ctx, sc_line):
     module, func = sc_line.args[1], sc_line.args[3]
     alias = sc_line.args[5] if len(sc_line.args) == 6 else None
 
-    # OK, let's pull in the module
-    __import__(module)
-    tmp = sys.modules[module]
+    # Have we already found this callable?
+    tmp = _import_cache.get((module, func))
+    if tmp is None:
+        # OK, let's pull in the module, if it isn't already loaded
+        tmp = sys.modules.get(module)
+        if tmp is None:
+            __import__(module)
+            tmp = sys.modules[module]
+
+        # Now, find the function
+        for elem in func.split('.'):
+            tmp = getattr(tmp, elem)
 
-    # Now, find the function
-    for elem in func.split('.'):
-        tmp = getattr(tmp, elem)
+        # The final one must be a callable
+        if not callable(tmp):
+            raise ImportError("No such callable %s in module %s" %
+                              (func, module))
 
-    # The final one must be a callable
-    if not callable(tmp):
-        raise ImportError("No such callable %s in module %s" %
-                          (func, module))
+        _import_cache[(module, func)] = tmp
 
     # Do we have an alias name?
     if alias is None:
@@ -169,6 +213,7 @@ def do_cd(ctx, sc_line):
     if directory is None:
         directory = os.environ.get('HOME')
     if directory is None:
+        import pwd
         directory = pwd.getpwuid(os.getuid())[5]
 
     # Change to the indicated directory
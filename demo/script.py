@@ -1,16 +1,74 @@
-import collections
 import os
-import readline
-import shlex
-import string
+import re
 import sys
-import traceback
 
 from demo import aliases
 
 __all__ = ['Script']
 
 
+# Matches the names of the %(name)s expansions in a prompt template
+_prompt_key_re = re.compile(r'%\((\w+)\)')
+
+# Matches the characters that str.split() can't handle like shlex
+# does; it also treats vertical tab and form feed as whitespace
+_needs_split_re = re.compile(r'[\'"\\\v\f]')
+
+# Matches the characters that only shlex can handle
+_needs_shlex_re = re.compile(r'[\\\v\f]')
+
+# Matches a word possibly containing quoted strings, and the parts of
+# such a word
+_word_re = re.compile(r'''(?:[^\s'"]+|"[^"]*"|'[^']*')+''')
+_word_part_re = re.compile(r'''"([^"]*)"|'([^']*)'|([^'"]+)''')
+
+
+def _split(line):
+    """
+    Splits `line` into words exactly as shlex.split() would.  Lines
+    with no quotes or escapes are split with str.split(), and lines
+    whose only special characters are balanced quotes are split using
+    regular expressions; only the remaining lines, which are rare,
+    need the slow shlex tokenizer.
+    """
+
+    # The common case: no quotes or escapes
+    if _needs_split_re.search(line) is None:
+        return line.split()
+
+    # Quotes, but no escapes
+    if _needs_shlex_re.search(line) is None:
+        words = _word_re.findall(line)
+
+        # Anything left over besides whitespace is an unbalanced quote
+        if not _word_re.sub('', line).strip():
+            return [''.join(''.join(part) for part in
+                            _word_part_re.findall(word))
+                    for word in words]
+
+    import shlex
+    return shlex.split(line)
+
+
+class _SubstDict(dict):
+    """
+    Helper dictionary used for computing substitutions.  Holds the
+    variables set by the script line itself; other variables are
+    looked up in the environment, and variables that are not set
+    substitute as the empty string.
+    """
+
+    __slots__ = ()
+
+    def __missing__(self, key):
+        """
+        Fall back to the environment; unset variables have an empty
+        value.
+        """
+
+        return os.environ.get(key, '')
+
+
 class PauseCommand(Exception):
     """
     Helper exception raised when a pause line is executed.
@@ -24,6 +82,8 @@ class ScriptLine(object):
     Represents a single line from a script.
     """
 
+    __slots__ = ('fname', 'lno', 'raw', 'output', 'type', 'vardict', 'args')
+
     @staticmethod
     def _subst(text, substs):
         """
@@ -34,8 +94,12 @@ class ScriptLine(object):
         result begins with '~'.  Returns the fully substituted string.
         """
 
-        # Start off with $ substitutions
-        tmp = string.Template(text).substitute(substs)
+        # Start off with $ substitutions, if there are any
+        if '$' in text:
+            import string
+            tmp = string.Template(text).substitute(substs)
+        else:
+            tmp = text
 
         # Perform tilde expansion
         if tmp and tmp[0] == '~':
@@ -65,28 +129,15 @@ class ScriptLine(object):
         line = self.raw
 
         # Inhibit output?
-        if line and line[0] == '!':
+        if line.startswith('!'):
             self.output = False
             line = line[1:]
         else:
             self.output = True
 
-        # Identify the line
-        if lno == 1 and line[0:2] == '#!':
-            self.type = 'comment'
-            self.output = False
-        elif line[0:2] == '##':
-            self.type = 'comment'
-            self.output = False
-        elif line and line[0] == '#':
-            self.type = 'comment'
-
-            # Take out leading '!'
-            if not self.output:
-                self.raw = line
-
-            self.output = True
-        elif not line:
+        # Identify the line from its first one or two characters
+        lead = line[:2]
+        if not lead:
             self.type = 'pause'
 
             # Take out leading '!'
@@ -94,6 +145,18 @@ class ScriptLine(object):
                 self.raw = line
 
             self.output = False
+        elif lead[0] == '#':
+            self.type = 'comment'
+
+            if lead == '##' or (lead == '#!' and lno == 1):
+                # Invisible comment or the "#!" line
+                self.output = False
+            else:
+                # Take out leading '!'
+                if not self.output:
+                    self.raw = line
+
+                self.output = True
         else:
             self.type = 'command'
 
@@ -104,13 +167,10 @@ class ScriptLine(object):
             return
 
         # OK, break down and process the command
-        args = shlex.split(line)
-
-        # Get substitutions dictionary
-        subst_dict = collections.defaultdict(lambda: '')
-        subst_dict.update(os.environ)
+        args = _split(line)
 
         # Handle pause and export commands specially
+        start = 0
         if args[0] == 'pause':
             self.raw = ''
             self.type = 'pause'
@@ -120,25 +180,37 @@ class ScriptLine(object):
             return
         elif args[0] == 'export':
             self.type = 'export'
-            args.pop(0)
+            start = 1
 
-        # Process the variable dictionary
+        # Get substitutions dictionary; the environment is consulted
+        # directly rather than copied
+        subst_dict = _SubstDict()
+
+        # Process the variable dictionary and the arguments in a
+        # single pass; only text containing '$' or starting with '~'
+        # needs substitution
         self.vardict = {}
-        while args and ('=' in args[0] or self.type == 'export'):
-            if '=' not in args[0]:
-                args.pop(0)
-                continue
-            name, value = args.pop(0).split('=', 1)
-            value = self._subst(value, subst_dict)
-            subst_dict[name] = value
-            self.vardict[name] = value
+        self.args = []
+        for idx in xrange(start, len(args)):
+            arg = args[idx]
+            if self.args or ('=' not in arg and self.type != 'export'):
+                # Everything from the first non-assignment is an argument
+                if '$' in arg or arg[:1] == '~':
+                    arg = self._subst(arg, subst_dict)
+                self.args.append(arg)
+            elif '=' in arg:
+                name, value = arg.split('=', 1)
+                if '$' in value or value[:1] == '~':
+                    value = self._subst(value, subst_dict)
+                subst_dict[name] = value
+                self.vardict[name] = value
 
         # Was that all the arguments?
-        if not args:
+        if not self.args:
             self.type = 'export'
-
-        # Save the arguments
-        self.args = [self._subst(arg, subst_dict) for arg in args]
+        elif isinstance(self.args[0], str):
+            # Intern the command name for fast alias lookups
+            self.args[0] = intern(self.args[0])
 
     def __str__(self):
         """
@@ -154,20 +226,38 @@ class ScriptLine(object):
         as a signal to the caller.
         """
 
-        # There are only a handful of types we can handle here...
-        if self.type == 'comment':
-            return
+        # There are only a handful of types we can handle here; test
+        # for commands, the most common, first
+        if self.type == 'command':
+            # OK, let's suck in and execute the appropriate command
+            return aliases.Alias.lookup(self.args[0]).func(ctx, self)
         elif self.type == 'pause':
             # Has to be handled at a level above us
             raise PauseCommand()
         elif self.type == 'export':
             # Just updating the environment
             os.environ.update(self.vardict)
-            return
 
-        # OK, let's suck in and execute the appropriate command
-        alias = aliases.Alias(self.args[0])
-        return alias.execute(ctx, self)
+        # Nothing to do for comments
+
+
+class _Source(object):
+    """
+    Represents an entry on the file stack: a source of ScriptLine
+    objects.
+    """
+
+    __slots__ = ('output', 'lines')
+
+    def __init__(self, output, lines):
+        """
+        Initialize a source.  The `output` boolean indicates whether
+        the lines should be displayed prior to execution, and `lines`
+        is an iterable of ScriptLine objects.
+        """
+
+        self.output = output
+        self.lines = iter(lines)
 
 
 class Script(object):
@@ -177,7 +267,7 @@ class Script(object):
     input sources.
     """
 
-    def __init__(self, opts):
+    def __init__(self, opts, record_history=None):
         """
         Initializes a script context.  The `opts` parameter is an
         object defining the following keys:
@@ -192,25 +282,57 @@ class Script(object):
 
             * debug - A boolean indicating whether to enable debugging
               output.
+
+        If `record_history` is True, lines read from files are added
+        to the readline history, so they can be recalled during
+        pauses; by default, they are recorded only if standard input
+        is a terminal.  The lines are collected as they are read and
+        added to the history just before each interactive prompt.
+        Either way, they are counted by the "nextcmd" prompt
+        expansion.
         """
 
         self.opts = opts
         self.exit_flag = False
 
+        # Only record history if someone can make use of it
+        if record_history is None:
+            record_history = sys.stdin.isatty()
+        self.record_history = record_history
+
         # Set up the filestack
         self.filestack = []
         self.empty = False
         for fname in reversed(opts.files):
             if fname == '-':
-                self.filestack.append((False, iter(self._read_input())))
+                self.filestack.append(_Source(False, self._read_input()))
             else:
-                self.filestack.append((True, iter(self._read_file(fname))))
+                self.filestack.append(_Source(True, self._read_file(fname)))
 
-        # Was outfile specified?
-        self.outfile = None if opts.output is None else open(opts.output, 'w')
+        # Was outfile specified?  It's flushed only when needed
+        self.outfile = (None if opts.output is None else
+                        open(opts.output, 'w', 1 << 16))
 
-        # Save the prompt template
+        # Save the prompt template and note which expansions it uses;
+        # a template with no expansions is formatted only once
         self.prompt_tmpl = opts.prompt
+        self._prompt_keys = frozenset(_prompt_key_re.findall(opts.prompt))
+        if self._prompt_keys:
+            self._prompt_fmt = opts.prompt.__mod__
+        else:
+            prompt = opts.prompt % {}
+            self._prompt_fmt = lambda values: prompt
+
+        # Length of the readline history and the current directory,
+        # for the prompt; None if they may have changed
+        self._history_len = None
+        self._currdir = None
+
+        # Script lines waiting to be added to the readline history,
+        # and the number of script lines that never will be; both
+        # still count toward the prompt's history position
+        self._pending_history = []
+        self._unrecorded_lines = 0
 
         # stdin line number
         self.in_lno = 1
@@ -232,17 +354,31 @@ class Script(object):
         """
 
         # Push another file to process
-        self.filestack.append((True, iter(self._read_file(fname))))
+        self.filestack.append(_Source(True, self._read_file(fname)))
 
     def _prompt(self):
         """
-        Helper routine to generate a prompt.
+        Helper routine to generate a prompt.  Only the values actually
+        referenced by the prompt template are computed.
         """
 
-        nextcmd = readline.get_current_history_length()
-        currdir = os.getcwd()
-
-        return self.prompt_tmpl % locals()
+        keys = self._prompt_keys
+        values = {}
+        if 'nextcmd' in keys:
+            if self._history_len is None:
+                # No history to count unless a prompt has loaded readline
+                readline = sys.modules.get('readline')
+                self._history_len = (0 if readline is None else
+                                     readline.get_current_history_length())
+            values['nextcmd'] = (self._history_len +
+                                 len(self._pending_history) +
+                                 self._unrecorded_lines)
+        if 'currdir' in keys:
+            if self._currdir is None:
+                self._currdir = os.getcwd()
+            values['currdir'] = self._currdir
+
+        return self._prompt_fmt(values)
 
     def _iter_lines(self):
         """
@@ -251,12 +387,19 @@ class Script(object):
         stack and reading of the next file on the stack is resumed.
         """
 
-        while self.filestack:
-            try:
+        filestack = self.filestack
+        while filestack:
+            top = filestack[-1]
+            output = top.output
+            for sc_line in top.lines:
                 # Yield the next line
-                yield (self.filestack[-1][0], next(self.filestack[-1][1]))
-            except StopIteration:
-                self.filestack.pop(-1)
+                yield (output, sc_line)
+
+                # Switch over if another file was pushed
+                if filestack[-1] is not top:
+                    break
+            else:
+                filestack.pop(-1)
 
     def _read_file(self, fname):
         """
@@ -264,47 +407,77 @@ class Script(object):
         `fname`.
         """
 
-        lno = 0
-        # Ignore leading blank lines that would be treated as pauses
-        inhibit_pause = True
-        with open(fname, 'r') as f:
-            for line in f:
-                # Track the line number
-                lno += 1
-
-                # Parse the line
-                sc_line = ScriptLine(fname, lno, line)
+        # History is collected here and only handed to readline when
+        # someone can make use of it; see _read_input()
+        pending_history = (self._pending_history if self.record_history
+                           else None)
 
-                # Process pauses
-                if sc_line.type == 'pause':
-                    if inhibit_pause:
-                        # Apply pause inhibition
-                        continue
+        # Read the whole file up front; scripts are small, and this
+        # avoids holding the file open while the script runs
+        with open(fname, 'r') as f:
+            lines = f.read().splitlines()
 
-                    # Inhibit future pausing
-                    inhibit_pause = True
-                else:
-                    # Not inhibiting any more pauses
-                    inhibit_pause = False
+        # Ignore leading blank lines that would be treated as pauses
+        inhibit_pause = True
+        for lno, line in enumerate(lines, 1):
+            # Parse the line
+            sc_line = ScriptLine(fname, lno, line)
+
+            # Process pauses
+            if sc_line.type == 'pause':
+                if inhibit_pause:
+                    # Apply pause inhibition
+                    continue
+
+                # Inhibit future pausing
+                inhibit_pause = True
+            else:
+                # Not inhibiting any more pauses
+                inhibit_pause = False
 
-                # Add the line to the history
-                readline.add_history(sc_line.raw)
+            # Add the line to the history, or at least count it
+            if pending_history is not None:
+                pending_history.append(sc_line.raw)
+            else:
+                self._unrecorded_lines += 1
 
-                # Yield the line
-                yield sc_line
+            # Yield the line
+            yield sc_line
 
     def _read_input(self):
         """
         Generator to read ScriptLine objects from standard input.
-        Ends when a blank line is entered.
+        Ends when a blank line is entered.  If standard input is not a
+        terminal, lines are read directly, without readline or a
+        prompt.
         """
 
-        # Helper to generate the prompt
-        def get_input():
-            try:
-                return raw_input(self._prompt()).strip()
-            except EOFError:
-                return ''
+        if sys.stdin.isatty():
+            # Importing readline enables line editing for raw_input()
+            import readline
+
+            # Helper to prompt for input
+            def get_input():
+                # Make the script lines read so far available for recall;
+                # a file sourced from this prompt may have queued more
+                if self._pending_history:
+                    for line in self._pending_history:
+                        readline.add_history(line)
+                    del self._pending_history[:]
+                    self._history_len = None
+
+                try:
+                    line = raw_input(self._prompt()).strip()
+                except EOFError:
+                    line = ''
+
+                # The input may have been added to the history
+                self._history_len = None
+                return line
+        else:
+            # Helper to read piped input
+            def get_input():
+                return sys.stdin.readline().strip()
 
         line = get_input()
         while line:
@@ -324,45 +497,74 @@ class Script(object):
         the file stack and executes them in turn.  Pause commands are
         handled by pushing the _read_input() generator onto the file
         stack.  Processing ends with a final pushing of _read_input()
-        onto the file stack.  This is the main loop.
+        onto the file stack.  The output script, if any, is flushed
+        before each pause and on return.
+        """
+
+        try:
+            self._execute()
+        finally:
+            # Make sure the output script is complete
+            self._flush()
+
+    def _flush(self):
+        """
+        Flushes the output script, if any.
+        """
+
+        if self.outfile is not None:
+            self.outfile.flush()
+
+    def _execute(self):
+        """
+        Helper for execute() implementing the main loop.
         """
 
         recent_pause = False
 
-        for output, sc_line in self._iter_lines():
-            # Write the output script, but skip "source" instructions
-            if (self.outfile is not None and
-                (sc_line.type != 'command' or
-                 sc_line.args[0] != '.')):
-                print >>self.outfile, str(sc_line)
-                self.outfile.flush()
-
-            # Do we need to emit the line to stdout?
-            if output and sc_line.output:
-                print "%s%s" % (self._prompt(), sc_line)
-
-            # Execute the line
-            try:
-                sc_line.execute(self)
-            except PauseCommand:
-                if not recent_pause:
-                    recent_pause = True
-                    self.filestack.append((False, iter(self._read_input())))
-                continue
-            except Exception, e:
-                print >>sys.stderr, ("Got exception %s at %s:%s" %
-                                     (e, sc_line.fname, sc_line.lno))
-                if self.opts.debug:
-                    traceback.print_exc()
-
-            recent_pause = False
-
-            # If we were instructed to exit, do so
-            if self.exit_flag:
+        while True:
+            for output, sc_line in self._iter_lines():
+                # Write the output script, but skip "source" instructions
+                if (self.outfile is not None and
+                    (sc_line.type != 'command' or
+                     sc_line.args[0] != '.')):
+                    print >>self.outfile, str(sc_line)
+
+                # Do we need to emit the line to stdout?
+                if output and sc_line.output:
+                    sys.stdout.write('%s%s\n' % (self._prompt(), sc_line.raw))
+
+                # Execute the line; commands may change the directory,
+                # and any output they produce must follow ours
+                if sc_line.type == 'command':
+                    self._currdir = None
+                    sys.stdout.flush()
+                try:
+                    sc_line.execute(self)
+                except PauseCommand:
+                    if not recent_pause:
+                        recent_pause = True
+                        self._flush()
+                        self.filestack.append(
+                            _Source(False, self._read_input()))
+                    continue
+                except Exception, e:
+                    print >>sys.stderr, ("Got exception %s at %s:%s" %
+                                         (e, sc_line.fname, sc_line.lno))
+                    if self.opts.debug:
+                        import traceback
+                        traceback.print_exc()
+
+                recent_pause = False
+
+                # If we were instructed to exit, do so
+                if self.exit_flag:
+                    return
+
+            # If we hit the end of input normally, throw on a final
+            # read from standard input and go around again
+            if recent_pause or self.empty:
                 return
-
-        # If we hit the end of input normally, throw on a final
-        if not recent_pause and not self.empty:
             self.empty = True
-            self.filestack.append((False, iter(self._read_input())))
-            return self.execute()
+            self._flush()
+            self.filestack.append(_Source(False, self._read_input()))